@@ -1,17 +1,32 @@
 import argparse
+import fcntl
+import hashlib
+import io
 import logging
 import os
 import plistlib
+import re
+import shutil
+import struct
 import subprocess
 import sys
 import tempfile
-from dataclasses import asdict, dataclass
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, BinaryIO, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple, Union
 from urllib.parse import ParseResult, urlparse
+from xml.etree import ElementTree
 
 import requests
 import sentry_sdk
+from requests.adapters import HTTPAdapter
+from sentry_sdk.tracing import Span
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
 
 
 @dataclass
@@ -41,6 +56,60 @@ DEVICES_TO_CHECK: Dict[str, List[Device]] = {
     "watchos": [],
 }
 
+# Keys read from Restore.plist, the rest of the file is skipped.
+_RESTORE_PLIST_KEYS = ("SystemRestoreImageFileSystems", "ProductBuildVersion", "ProductVersion")
+
+# Read buffer used when streaming IPSW archives and their restore images to disk. These are
+# several GB, so a large buffer keeps the number of Python-level read/write round-trips low.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Interrupted downloads are resumed from where they stopped and failed range requests are
+# retried, up to this many attempts in total.
+DOWNLOAD_ATTEMPTS = 5
+
+# Shared by every HTTP call so connections to api.ipsw.me and Apple's CDN are kept alive.
+SESSION = requests.Session()
+# Sized for the concurrent device probes on top of the archive fetches.
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+    ),
+)
+# (connect, read) timeouts in seconds, a stalled connection would otherwise hang the run forever.
+HTTP_TIMEOUT = (10, 300)
+
+# fcntl(2) constants to preallocate files on macOS, not all of them are exposed by the fcntl module.
+_F_PREALLOCATE = 42
+_F_ALLOCATECONTIG = 0x2
+_F_ALLOCATEALL = 0x4
+_F_PEOFPOSMODE = 3
+
+# Size of the HTTP range requests made when reading archives straight from the server.
+REMOTE_ARCHIVE_BLOCK_SIZE = 8 << 20
+# Number of blocks fetched concurrently ahead of sequential reads of a remote archive.
+REMOTE_ARCHIVE_READ_AHEAD = 4
+
+# Root for the scratch directories used while extracting symbols. Defaults to the system temporary
+# directory, pointing it at a RAM disk avoids hitting the SSD for multi-GB intermediate files.
+SCRATCH_DIR = os.environ.get("SENTRY_SCRATCH_DIR")
+
+# Upper bound of concurrent api.ipsw.me lookups.
+MAX_CONCURRENT_PROBES = 8
+
+# Trace every step of the extraction (mounting, extracting each shared cache, running symsorter...).
+# Off by default, runs are only traced per archive.
+TRACE_EXTRACT = os.environ.get("SENTRY_TRACE_EXTRACT") == "1"
+
+# Every IPSW is several GB on disk. At most this many are fetched, waiting for extraction or being
+# extracted at any time, counting from the start of the fetch until the extracted files are deleted.
+MAX_CONCURRENT_DOWNLOADS = 2
+
+# An extracted shared cache takes several GB. At most this many are being extracted or waiting
+# for symsorter at any time, counting until their extracted files are deleted.
+MAX_CONCURRENT_EXTRACTIONS = 2
+
 
 @dataclass
 class IPSW:
@@ -49,6 +118,8 @@ class IPSW:
     os_name: str
     os_version: str
     url: ParseResult
+    # Advertised by api.ipsw.me, used to verify full downloads.
+    sha1sum: Optional[str] = None
 
     @property
     def bundle_id(self) -> str:
@@ -71,6 +142,11 @@ def main():
     if args.os_name is None:
         sys.exit("You need to specify an OS name to check for.")
 
+    # Only set up the SDK (and its transport thread) once the arguments are known to be valid.
+    sentry_sdk.init(
+        dsn="https://f86a0e29c86e49688d691e194c5bf9eb@o1.ingest.sentry.io/6418660",
+        traces_sample_rate=1.0,
+    )
     with sentry_sdk.start_transaction(
         op="task", name="import symbols from IPSW archive"
     ) as transaction:
@@ -80,73 +156,334 @@ def main():
                 return
             span.set_data("new_archives", ipsws)
 
-        with tempfile.TemporaryDirectory(prefix="_sentry_symcache_output_") as symcache_output:
-            with tempfile.TemporaryDirectory(prefix="_sentry_ipsw_archives_") as ipsw_dir:
-                for ipsw in ipsws:
+        with tempfile.TemporaryDirectory(
+            prefix="_sentry_symcache_output_", dir=SCRATCH_DIR
+        ) as symcache_output:
+            with tempfile.TemporaryDirectory(
+                prefix="_sentry_ipsw_archives_", dir=SCRATCH_DIR
+            ) as ipsw_dir:
+                process_ipsws(transaction, ipsws, ipsw_dir, symcache_output)
+
+
+def process_ipsws(
+    transaction: Span, ipsws: List[IPSW], ipsw_dir: str, symcache_output: str
+) -> None:
+    # Archives are downloaded and unzipped on their own threads, so the next one is fetched while
+    # the current restore image is being processed. Each archive's symbols are uploaded in the
+    # background as soon as they are sorted, and extracted files are deleted in the background as
+    # well.
+    pending = list(ipsws)
+    fetches: Dict["Future[str]", IPSW] = {}
+    cleanups: Set["Future[None]"] = set()
+    uploads = []
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as fetch_executor:
+        with ThreadPoolExecutor(max_workers=1) as upload_executor, ThreadPoolExecutor(
+            max_workers=1
+        ) as cleanup_executor:
+            while pending or fetches:
+                # An archive holds a slot from the start of its fetch until its extracted files
+                # are deleted, which bounds how far fetches get ahead of the extraction.
+                while pending and len(fetches) + len(cleanups) < MAX_CONCURRENT_DOWNLOADS:
+                    ipsw = pending.pop(0)
+                    fetch = fetch_executor.submit(fetch_one_ipsw, transaction, ipsw, ipsw_dir)
+                    fetches[fetch] = ipsw
+                done, _ = wait([*fetches, *cleanups], return_when=FIRST_COMPLETED)
+                cleanups -= done
+                for fetch in [fetch for fetch in done if fetch in fetches]:
+                    ipsw = fetches.pop(fetch)
+                    extract_dir = fetch.result()
                     with transaction.start_child(
                         op="task", description="Process IPSW archive"
                     ) as ipsw_span:
-                        for k, v in asdict(ipsw).items():
-                            ipsw_span.set_data(k, v)
+                        for field in fields(ipsw):
+                            if field.name != "url":
+                                ipsw_span.set_data(field.name, getattr(ipsw, field.name))
+                        ipsw_span.set_data("url", ipsw.url.geturl())
 
-                        with ipsw_span.start_child(
-                            op="task", description="Download new version"
-                        ) as span:
-                            local_path = os.path.join(ipsw_dir, os.path.basename(ipsw.url.path))
-                            url = ipsw.url.geturl()
-                            span.set_data("url", url)
-                            download_ipsw_archive(url, local_path)
+                        output_path = tempfile.mkdtemp(
+                            prefix=f"{ipsw.bundle_id}_", dir=symcache_output
+                        )
                         with ipsw_span.start_child(
                             op="task", description="Extract symbols from archive"
-                        ) as span:
-                            with tempfile.TemporaryDirectory(
-                                prefix="_sentry_ipsw_extract_dir_"
-                            ) as extract_dir:
-                                extract_symbols_from_one_archive(
-                                    local_path,
-                                    extract_dir,
-                                    symcache_output,
-                                    ipsw.os_name,
-                                    ipsw.architecture,
-                                )
-            with transaction.start_child(op="task", description="Upload symbols to GCS bucket"):
-                upload_to_gcs(symcache_output)
-
-
-def download_ipsw_archive(url: str, filepath: str) -> None:
+                        ):
+                            extract_symbols_from_one_archive(
+                                extract_dir,
+                                output_path,
+                                ipsw.os_name,
+                                ipsw.architecture,
+                            )
+                    cleanups.add(
+                        cleanup_executor.submit(shutil.rmtree, extract_dir, ignore_errors=True)
+                    )
+                    uploads.append(upload_executor.submit(upload_symbols, transaction, output_path))
+            for upload in uploads:
+                upload.result()
+
+
+def fetch_one_ipsw(parent_span: Span, ipsw: IPSW, ipsw_dir: str) -> str:
+    # Runs on a worker thread, so use a dedicated hub to keep the main thread's scope intact.
+    with sentry_sdk.Hub(sentry_sdk.Hub.current):
+        url = ipsw.url.geturl()
+        extract_dir = os.path.join(ipsw_dir, f"{ipsw.bundle_id}_extract_dir")
+        remote_archive = open_remote_archive(url)
+        if remote_archive is not None:
+            # Only fetch the parts of the archive that are extracted instead of the whole IPSW.
+            with parent_span.start_child(
+                op="task", description="Extract IPSW archive over HTTP"
+            ) as span:
+                span.set_data("url", url)
+                logging.info(f"Extracting from {url}")
+                with remote_archive:
+                    extract_restore_image(remote_archive, extract_dir)
+            return extract_dir
+
+        with parent_span.start_child(op="task", description="Download new version") as span:
+            # Several IPSWs can share an archive, keep their downloads apart.
+            local_path = os.path.join(
+                ipsw_dir, f"{ipsw.bundle_id}_{os.path.basename(ipsw.url.path)}"
+            )
+            span.set_data("url", url)
+            download_ipsw_archive(url, local_path, ipsw.sha1sum)
+        with extract_span(parent_span, "Extract IPSW archive"):
+            extract_restore_image(local_path, extract_dir)
+        # The archive is no longer needed, free the disk space for the next ones.
+        os.remove(local_path)
+    return extract_dir
+
+
+def upload_symbols(parent_span: Span, symcache_dir: str) -> None:
+    with sentry_sdk.Hub(sentry_sdk.Hub.current):
+        with parent_span.start_child(op="task", description="Upload symbols to GCS bucket"):
+            upload_to_gcs(symcache_dir)
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """A read-only, seekable view of a remote file, backed by HTTP range requests."""
+
+    def __init__(self, url: str, size: int, read_ahead: int = REMOTE_ARCHIVE_READ_AHEAD):
+        self.url = url
+        self.size = size
+        self.position = 0
+        # The file is fetched in fixed blocks. Once reads go sequential, the next blocks are
+        # requested on their own connections since a single stream is bound by TCP throughput.
+        self.read_ahead = read_ahead
+        self.executor = ThreadPoolExecutor(max_workers=max(1, read_ahead))
+        self.blocks: Dict[int, "Future[bytes]"] = {}
+        self.last_block_start = -1
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def close(self) -> None:
+        for block in self.blocks.values():
+            block.cancel()
+        self.blocks.clear()
+        self.executor.shutdown(wait=True)
+        super().close()
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+        block_start = self.position - self.position % REMOTE_ARCHIVE_BLOCK_SIZE
+        data = self.get_block(block_start).result()
+        offset = self.position - block_start
+        size = min(len(buffer), len(data) - offset)
+        buffer[:size] = data[offset : offset + size]
+        self.position += size
+        return size
+
+    def get_block(self, block_start: int) -> "Future[bytes]":
+        sequential = block_start == self.last_block_start + REMOTE_ARCHIVE_BLOCK_SIZE
+        self.last_block_start = block_start
+        window_end = block_start + (self.read_ahead + 1) * REMOTE_ARCHIVE_BLOCK_SIZE
+        # Drop blocks that were read already or skipped by a seek.
+        for start in [start for start in self.blocks if not block_start <= start < window_end]:
+            self.blocks.pop(start).cancel()
+        starts = [block_start]
+        if sequential:
+            starts.extend(
+                range(
+                    block_start + REMOTE_ARCHIVE_BLOCK_SIZE,
+                    min(window_end, self.size),
+                    REMOTE_ARCHIVE_BLOCK_SIZE,
+                )
+            )
+        for start in starts:
+            if start not in self.blocks:
+                end = min(start + REMOTE_ARCHIVE_BLOCK_SIZE, self.size)
+                self.blocks[start] = self.executor.submit(self.fetch, start, end)
+        return self.blocks[block_start]
+
+    def fetch(self, start: int, end: int) -> bytes:
+        # Retry only covers failures before the response, a connection reset while the body is
+        # read would otherwise fail the whole archive.
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                return self.fetch_block(start, end)
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                ProtocolError,
+            ) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                logging.info(
+                    f"Fetching bytes {start}-{end - 1} of {self.url} failed, retrying: {e}"
+                )
+        raise AssertionError("unreachable")
+
+    def fetch_block(self, start: int, end: int) -> bytes:
+        with SESSION.get(
+            self.url,
+            stream=True,
+            headers={"Range": f"bytes={start}-{end - 1}", "Accept-Encoding": "identity"},
+            timeout=HTTP_TIMEOUT,
+        ) as res:
+            res.raise_for_status()
+            # Check before reading, a server ignoring the range would send the whole archive.
+            if res.status_code != 206:
+                raise RuntimeError(f"{self.url} ignored the range request")
+            content = res.content
+        # A short body would otherwise end up as a silently truncated restore image.
+        if len(content) != end - start:
+            raise ProtocolError(
+                f"Got {len(content)} bytes instead of {end - start} from {self.url}"
+            )
+        return content
+
+
+def open_remote_archive(url: str) -> Optional[BinaryIO]:
+    res = SESSION.head(
+        url,
+        allow_redirects=True,
+        headers={"Accept-Encoding": "identity"},
+        timeout=HTTP_TIMEOUT,
+    )
+    if not res.ok or res.headers.get("Accept-Ranges") != "bytes":
+        return None
+    size = int(res.headers.get("Content-Length", 0))
+    if size == 0:
+        return None
+    # Reads go through a large buffer so sequential reads of the restore image map to a
+    # reasonable number of range requests.
+    return io.BufferedReader(HTTPRangeFile(res.url, size), buffer_size=REMOTE_ARCHIVE_BLOCK_SIZE)
+
+
+def download_ipsw_archive(url: str, filepath: str, expected_sha1: Optional[str] = None) -> None:
     logging.info(f"Downloading {url}")
-    r = requests.get(url, stream=True)
-    with open(filepath, "wb") as f:
-        for chunk in r.iter_content(chunk_size=8192):
+    # Write next to the destination and move it into place once complete, so an interrupted
+    # download never leaves a truncated archive at filepath.
+    partial_path = f"{filepath}.part"
+    # Hash while writing, so a corrupted download fails here instead of when unzipping it.
+    digest = hashlib.sha1()
+    with open(partial_path, "wb") as f:
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                if download_ipsw_archive_range(url, f, digest):
+                    break
+                raise ProtocolError("Connection closed before the end of the archive")
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                ProtocolError,
+                ReadTimeoutError,
+            ) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                logging.info(f"Download interrupted after {f.tell()} bytes, resuming: {e}")
+        f.truncate()
+    if expected_sha1 is not None and digest.hexdigest() != expected_sha1.lower():
+        os.remove(partial_path)
+        raise ValueError(f"Checksum mismatch for {url}: expected {expected_sha1}")
+    os.replace(partial_path, filepath)
+
+
+def download_ipsw_archive_range(url: str, f: BinaryIO, digest: Any) -> bool:
+    # IPSWs are already compressed, don't let urllib3 try to decode them.
+    headers = {"Accept-Encoding": "identity"}
+    offset = f.tell()
+    if offset:
+        # Pick up a previous attempt where it stopped instead of fetching several GB again.
+        headers["Range"] = f"bytes={offset}-"
+    with SESSION.get(url, stream=True, headers=headers, timeout=HTTP_TIMEOUT) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        if offset and r.status_code != 206:
+            raise RuntimeError(f"{url} ignored the range request, can't resume the download")
+        remaining = int(r.headers.get("Content-Length", 0))
+        if not offset:
+            preallocate(f, remaining)
+        for chunk in iter(lambda: r.raw.read(DOWNLOAD_CHUNK_SIZE), b""):
             f.write(chunk)
+            digest.update(chunk)
+    # Without a length, a closed connection can't be told apart from the end of the archive.
+    return not remaining or f.tell() - offset >= remaining
+
+
+def extract_restore_image(archive: Union[str, BinaryIO], extract_dir: str) -> None:
+    os.makedirs(extract_dir)
+    # Only Restore.plist and the system restore image are needed, skip everything else.
+    extract_ipsw_archive(archive, extract_dir, ["Restore.plist"])
+    restore_images, _, _ = read_restore_plist(os.path.join(extract_dir, "Restore.plist"))
+    # Use the first one only since the rest is the recovery OS
+    extract_ipsw_archive(archive, extract_dir, [next(iter(restore_images))])
+
+
+def preallocate(f: BinaryIO, size: int) -> None:
+    # Reserve the space of multi-GB files up front so they are written to contiguous extents
+    # instead of growing the file chunk by chunk. This is best effort, errors are ignored. The file
+    # may be extended to size, so callers truncate it once written.
+    if size <= 0:
+        return
+    try:
+        if sys.platform == "darwin":
+            # struct fstore { fst_flags, fst_posmode, fst_offset, fst_length, fst_bytesalloc }
+            for flags in (_F_ALLOCATECONTIG | _F_ALLOCATEALL, _F_ALLOCATEALL):
+                fstore = struct.pack("Iiqqq", flags, _F_PEOFPOSMODE, 0, size, 0)
+                try:
+                    fcntl.fcntl(f.fileno(), _F_PREALLOCATE, fstore)
+                    return
+                except OSError:
+                    continue
+        elif hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+    except OSError:
+        pass
 
 
 def extract_symbols_from_one_archive(
-    ipsw_archive_path: str,
     extract_dir: str,
     symcache_output_path: str,
     prefix: str,
     architecture: str,
 ) -> None:
     span = sentry_sdk.Hub.current.scope.span
-    with span.start_child(op="task", description="Extract IPSW archive"):
-        extract_ipsw_archive(ipsw_archive_path, extract_dir)
     plist_path = os.path.join(extract_dir, "Restore.plist")
-    (restore_images, os_version, build_number) = read_restore_plist(plist_path)
-
-    # Use the first one only since the rest is the recovery OS
-    system_restore_image_filename = list(restore_images.keys())[0]
+    restore_images, os_version, build_number = read_restore_plist(plist_path)
+    system_restore_image_filename = next(iter(restore_images))
     restore_image_path = os.path.join(extract_dir, system_restore_image_filename)
 
     logging.info(f"Mounting {restore_image_path}")
-    with span.start_child(op="task", description="Mount archive"):
-        volume_path = (
-            subprocess.check_output(
-                [f"hdiutil attach {restore_image_path} | grep /Volumes/ | cut -f 3"], shell=True
-            )
-            .decode("utf-8")
-            .strip()
-        )
+    with extract_span(span, "Mount archive"):
+        volume_path = mount_disk_image(restore_image_path)
 
     try:
         bundle_id = f"{os_version}_{build_number}_{architecture}"
@@ -166,45 +503,72 @@ def extract_symbols_from_one_archive(
                 "Caches",
                 "com.apple.dyld",
             )
-        for filename in os.listdir(shared_cache_dir):
+        other_dylib_paths = [
+            os.path.join(volume_path, "usr", "lib"),
+            os.path.join(volume_path, "System", "Library", "AccessibilityBundles"),
+        ]
+        # symsorter runs on its own thread while shared caches are being extracted. Its runs are
+        # kept sequential since they all write to the same bundle in the output directory.
+        with tempfile.TemporaryDirectory(
+            prefix="_sentry_dylib_cache_output", dir=SCRATCH_DIR
+        ) as dylib_cache_output, ThreadPoolExecutor(max_workers=1) as symsorter_executor:
+            symsorter_jobs = [
+                symsorter_executor.submit(
+                    run_symsorter_job,
+                    span,
+                    "Run symsorter for other dylib paths",
+                    symcache_output_path,
+                    prefix,
+                    bundle_id,
+                    other_dylib_paths,
+                )
+            ]
+
             # iOS 15.0+ firmwares have multiple dyld_shared_cache files for the same architecture,
             # e.g. dyld_shared_cache_arm64e.1, dyld_shared_cache_arm64e.2, etc.
             # We can ignore these: https://github.com/keith/dyld-shared-cache-extractor/issues/1#issuecomment-924265280
             #
             # To extract these, Xcode 13.0+ needs to be the selected Xcode version.
-            if not filename.startswith("dyld_shared_cache") or os.path.splitext(filename)[1] != "":
-                continue
-            with tempfile.TemporaryDirectory(prefix="_sentry_dylib_cache_output") as output_path:
-                with span.start_child(
-                    op="task", description="Process shared cache file"
-                ) as shared_cache_span:
-                    shared_cache_span.set_data("shared_cache_file", filename)
-                    cache_path = os.path.join(shared_cache_dir, filename)
-                    logging.info(f"Extracting {cache_path} to {output_path}")
-                    with shared_cache_span.start_child(
-                        op="task", description="Run dyld-shared-cache-extractor"
-                    ):
-                        subprocess.check_call(
-                            ["dyld-shared-cache-extractor", cache_path, output_path]
+            cache_files = list_shared_cache_files(shared_cache_dir)
+            # The mounted image is read-only, so the shared caches can be extracted concurrently.
+            # Each one is handed to symsorter as soon as it is done. A new extraction is only
+            # started once symsorter has removed an earlier one, so no more than
+            # MAX_CONCURRENT_EXTRACTIONS extracted caches are on disk at once.
+            pending = list(cache_files)
+            extractions: Set["Future[str]"] = set()
+            sorts: Set["Future[None]"] = set()
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_EXTRACTIONS) as extractor_executor:
+                while pending or extractions:
+                    while pending and len(extractions) + len(sorts) < MAX_CONCURRENT_EXTRACTIONS:
+                        cache_file = pending.pop(0)
+                        extraction = extractor_executor.submit(
+                            extract_shared_cache,
+                            span,
+                            cache_file.path,
+                            os.path.join(dylib_cache_output, cache_file.name),
                         )
-                    with shared_cache_span.start_child(
-                        op="task", description="Run symsorter for shared cache directory"
-                    ):
-                        symsorter(symcache_output_path, prefix, bundle_id, output_path)
-
-        other_dylib_paths = [
-            os.path.join(volume_path, "usr", "lib"),
-            os.path.join(volume_path, "System", "Library", "AccessibilityBundles"),
-        ]
-        for dylib_path in other_dylib_paths:
-            with span.start_child(
-                op="task", description="Run symsorter for other dylib paths"
-            ) as other_path_span:
-                other_path_span.set_data("dylib_path", dylib_path)
-                symsorter(symcache_output_path, prefix, bundle_id, dylib_path)
+                        extractions.add(extraction)
+                    done, _ = wait([*extractions, *sorts], return_when=FIRST_COMPLETED)
+                    sorts -= done
+                    for extraction in extractions & done:
+                        extractions.remove(extraction)
+                        sort = symsorter_executor.submit(
+                            run_symsorter_job,
+                            span,
+                            "Run symsorter for shared cache directory",
+                            symcache_output_path,
+                            prefix,
+                            bundle_id,
+                            [extraction.result()],
+                            remove_input=True,
+                        )
+                        symsorter_jobs.append(sort)
+                        sorts.add(sort)
+            for job in symsorter_jobs:
+                job.result()
     finally:
         logging.info(f"Unmounting {restore_image_path}")
-        with span.start_child(op="task", description="Unmount archive"):
+        with extract_span(span, "Unmount archive"):
             subprocess.check_call(
                 ["hdiutil", "detach", volume_path],
                 stdout=subprocess.DEVNULL,
@@ -212,7 +576,85 @@ def extract_symbols_from_one_archive(
             )
 
 
-def symsorter(output_path: str, prefix: str, bundle_id: str, input_path: str) -> None:
+def list_shared_cache_files(shared_cache_dir: str) -> List[os.DirEntry]:
+    with os.scandir(shared_cache_dir) as entries:
+        return [
+            entry
+            for entry in entries
+            if entry.name.startswith("dyld_shared_cache") and "." not in entry.name
+        ]
+
+
+def extract_shared_cache(parent_span: Span, cache_path: str, output_path: str) -> str:
+    # Runs on a worker thread, so use a dedicated hub to keep the main thread's scope intact.
+    with sentry_sdk.Hub(sentry_sdk.Hub.current):
+        with extract_span(parent_span, "Run dyld-shared-cache-extractor") as span:
+            if span is not None:
+                span.set_data("shared_cache_file", os.path.basename(cache_path))
+            logging.info(f"Extracting {cache_path} to {output_path}")
+            subprocess.check_call(["dyld-shared-cache-extractor", cache_path, output_path])
+    return output_path
+
+
+@contextmanager
+def extract_span(parent: Span, description: str) -> Iterator[Optional[Span]]:
+    """Starts a child span for one extraction step, only when SENTRY_TRACE_EXTRACT=1."""
+    if not TRACE_EXTRACT:
+        # Steps run concurrently, their data must not end up overwriting each other on the parent.
+        yield None
+        return
+    with parent.start_child(op="task", description=description) as span:
+        yield span
+
+
+def mount_disk_image(image_path: str) -> str:
+    # The image comes straight from the downloaded archive, skip checksum verification and mount it
+    # read-only since nothing is written to it.
+    output = subprocess.check_output(
+        [
+            "hdiutil",
+            "attach",
+            image_path,
+            "-plist",
+            "-nobrowse",
+            "-noautoopen",
+            "-readonly",
+            "-noverify",
+        ]
+    )
+    for entity in plistlib.loads(output)["system-entities"]:
+        mount_point = entity.get("mount-point", "")
+        if mount_point.startswith("/Volumes/"):
+            return mount_point
+    raise RuntimeError(f"Could not find where {image_path} was mounted")
+
+
+def run_symsorter_job(
+    parent_span: Span,
+    description: str,
+    output_path: str,
+    prefix: str,
+    bundle_id: str,
+    input_paths: List[str],
+    remove_input: bool = False,
+) -> None:
+    # Runs on a worker thread, so use a dedicated hub to keep the main thread's scope intact.
+    with sentry_sdk.Hub(sentry_sdk.Hub.current):
+        with extract_span(parent_span, description) as span:
+            if span is not None:
+                span.set_data("input_paths", input_paths)
+            try:
+                symsorter(output_path, prefix, bundle_id, *input_paths)
+            finally:
+                if remove_input:
+                    # Free the space right away, extracted shared caches take several GB.
+                    for input_path in input_paths:
+                        shutil.rmtree(input_path, ignore_errors=True)
+
+
+def symsorter(output_path: str, prefix: str, bundle_id: str, *input_paths: str) -> None:
+    # symsorter takes any number of inputs, pass them all at once to pay its startup and output
+    # directory scan only once.
     subprocess.check_call(
         [
             "./symsorter",
@@ -224,23 +666,43 @@ def symsorter(output_path: str, prefix: str, bundle_id: str, input_path: str) ->
             prefix,
             "--bundle-id",
             bundle_id,
-            input_path,
+            *input_paths,
         ]
     )
 
 
-def extract_ipsw_archive(archive_path: str, extract_dir: str) -> None:
-    logging.info(f"Extracting {archive_path} to {extract_dir}")
-    subprocess.check_call(
-        ["unzip", archive_path, "-d", extract_dir],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
+def extract_ipsw_archive(
+    archive_file: Union[str, BinaryIO], extract_dir: str, members: List[str]
+) -> None:
+    logging.info(f"Extracting {', '.join(members)} to {extract_dir}")
+    with zipfile.ZipFile(archive_file) as archive:
+        for member in members:
+            parts = member.split("/")
+            if member.startswith("/") or ".." in parts:
+                raise ValueError(f"Refusing to extract {member} outside of {extract_dir}")
+            target_path = os.path.join(extract_dir, *parts)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            # ZipFile.extract copies with a small buffer, the restore image is several GB.
+            with archive.open(member) as source, open(target_path, "wb") as target:
+                preallocate(target, archive.getinfo(member).file_size)
+                shutil.copyfileobj(source, target, length=DOWNLOAD_CHUNK_SIZE)
+                target.truncate()
 
 
 def read_restore_plist(plist_path: str):
+    # Restore.plist is read once when unzipping the archive and again when processing the image.
+    return read_restore_plist_cached(plist_path, os.path.getmtime(plist_path))
+
+
+@lru_cache(maxsize=16)
+def read_restore_plist_cached(plist_path: str, mtime: float):
     with open(plist_path, "rb") as f:
-        plist = plistlib.load(f)
+        is_binary = f.read(8) == b"bplist00"
+        f.seek(0)
+        if is_binary:
+            plist = plistlib.load(f)
+        else:
+            plist = scan_xml_plist(f, _RESTORE_PLIST_KEYS)
         restore_images = plist["SystemRestoreImageFileSystems"]
         build_number = plist["ProductBuildVersion"]
         os_version = plist["ProductVersion"]
@@ -250,6 +712,46 @@ def read_restore_plist(plist_path: str):
     return restore_images, os_version, build_number
 
 
+def scan_xml_plist(f: BinaryIO, keys: Tuple[str, ...]) -> Dict[str, Any]:
+    """Reads the given top-level keys of an XML plist, stopping as soon as all of them are found."""
+    values: Dict[str, Any] = {}
+    depth = 0
+    key = None
+    for event, elem in ElementTree.iterparse(f, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        # Only look at the children of the top-level dict (plist > dict > child).
+        if depth != 2:
+            continue
+        if elem.tag == "key":
+            key = elem.text
+        else:
+            if key in keys:
+                values[key] = xml_plist_value(elem)
+            key = None
+        elem.clear()
+        if len(values) == len(keys):
+            break
+    return values
+
+
+def xml_plist_value(elem: ElementTree.Element) -> Any:
+    if elem.tag == "dict":
+        children = list(elem)
+        return {k.text: xml_plist_value(v) for k, v in zip(children[::2], children[1::2])}
+    if elem.tag == "array":
+        return [xml_plist_value(child) for child in elem]
+    if elem.tag == "integer":
+        return int(elem.text or 0)
+    if elem.tag == "real":
+        return float(elem.text or 0)
+    if elem.tag in ("true", "false"):
+        return elem.tag == "true"
+    return elem.text or ""
+
+
 def upload_to_gcs(symcache_dir: str):
     if not any(Path(symcache_dir).iterdir()):
         logging.info(f"Directory {symcache_dir} is empty, nothing to do.")
@@ -265,17 +767,47 @@ def get_missing_ipsws(os_name: str, os_version: str) -> List[IPSW]:
         return []
 
     span = sentry_sdk.Hub.current.scope.span
-    build_to_ipsw: Dict[str, IPSW] = {}
-    for device in DEVICES_TO_CHECK.get(os_name, []):
-        with span.start_child(op="http.client", description="Fetch latest versions") as device_span:
-            res = requests.get(
-                f"https://api.ipsw.me/v2.1/{device.identifier}/{os_version}/info.json"
-            )
-            res.raise_for_status()
-            if len(res.json()) == 0:
-                continue
+    with span.start_child(op="task", description="List bundles in cloud storage"):
+        existing_bundles = list_bundles_in_cloud_storage(os_name)
+    # Query all devices at once, the lookups are bound by round-trips to api.ipsw.me.
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PROBES) as executor:
+        probes = [
+            executor.submit(probe_device, span, device, os_name, os_version, existing_bundles)
+            for device in DEVICES_TO_CHECK[os_name]
+        ]
+        ipsws = [probe.result() for probe in probes]
+
+    build_to_ipsw: Dict[Tuple[str, str, str, str], IPSW] = {}
+    for ipsw in ipsws:
+        if ipsw is None:
+            continue
+        build_key = (os_name, ipsw.os_version, ipsw.build_number, ipsw.architecture)
+        if build_key in build_to_ipsw:
+            continue
+
+        build_to_ipsw[build_key] = ipsw
+    return list(build_to_ipsw.values())
 
-            ipsw_info = res.json()[0]
+
+def probe_device(
+    parent_span: Span,
+    device: Device,
+    os_name: str,
+    os_version: str,
+    existing_bundles: FrozenSet[str],
+) -> Optional[IPSW]:
+    # Runs on a worker thread, so use a dedicated hub to keep the main thread's scope intact.
+    with sentry_sdk.Hub(sentry_sdk.Hub.current):
+        with parent_span.start_child(
+            op="http.client", description="Fetch latest versions"
+        ) as device_span:
+            payload = fetch_ipsw_infos(device.identifier, os_version)
+            if not payload:
+                return None
+
+            # Don't rely on the ordering of the response, a wrong pick means downloading and
+            # extracting a stale firmware end-to-end.
+            ipsw_info = max(payload, key=lambda info: parse_version(info["version"]))
             latest_os_version = ipsw_info["version"]
             latest_build_number = ipsw_info["buildid"]
             ipsw = IPSW(
@@ -284,6 +816,7 @@ def get_missing_ipsws(os_name: str, os_version: str) -> List[IPSW]:
                 url=urlparse(ipsw_info["url"]),
                 os_name=os_name,
                 architecture=device.architecture,
+                sha1sum=ipsw_info.get("sha1sum"),
             )
             device_span.set_data("latest_os_version", latest_os_version)
             device_span.set_data("latest_build_nunber", latest_build_number)
@@ -291,40 +824,59 @@ def get_missing_ipsws(os_name: str, os_version: str) -> List[IPSW]:
             with device_span.start_child(
                 op="task", description="Check if version has symbols already"
             ) as symbols_span:
-                if has_symbols_in_cloud_storage(ipsw.os_name, ipsw.bundle_id):
+                if ipsw.bundle_id in existing_bundles:
                     symbols_span.set_data("has_symbols_in_cloud_storage", True)
                     logging.info(f"We already have symbols for {ipsw.bundle_id}")
-                    continue
+                    return None
+    return ipsw
 
-            build_key = f"{os_name}-{latest_os_version}-{latest_build_number}-{device.architecture}"
-            if build_to_ipsw.get(build_key):
-                continue
 
-            build_to_ipsw[build_key] = ipsw
-    return list(build_to_ipsw.values())
+def fetch_ipsw_infos(identifier: str, os_version: str) -> List[Dict[str, Any]]:
+    firmwares = fetch_device_firmwares(identifier)
+    if os_version == "latest":
+        return firmwares
+    return [firmware for firmware in firmwares if firmware["version"] == os_version]
 
 
-def has_symbols_in_cloud_storage(prefix: str, bundle_id: str) -> bool:
-    storage_path = f"gs://sentryio-system-symbols-0/{prefix}/bundles/{bundle_id}"
+def fetch_device_firmwares(identifier: str) -> List[Dict[str, Any]]:
+    # A single v4 query lists every firmware of the device, the version is filtered locally.
+    res = SESSION.get(
+        f"https://api.ipsw.me/v4/device/{identifier}",
+        params={"type": "ipsw"},
+        timeout=HTTP_TIMEOUT,
+    )
+    res.raise_for_status()
+    return res.json()["firmwares"]
+
+
+# Listed once per prefix and process, every later existence check is a set lookup.
+@lru_cache(maxsize=None)
+def list_bundles_in_cloud_storage(prefix: str) -> FrozenSet[str]:
+    storage_path = f"gs://sentryio-system-symbols-0/{prefix}/bundles/"
     result = subprocess.run(
-        ["gsutil", "stat", storage_path],
+        ["gsutil", "ls", storage_path],
         encoding="utf-8",
         stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
+        stderr=subprocess.PIPE,
     )
-    if result.returncode == 0:
-        return True
-    elif "No URLs matched" in result.stdout:
-        return False
-    # Fallback to raising an exception for other errors.
-    print(result.stdout)
-    result.check_returncode()
-    return False
+    if result.returncode != 0:
+        if "matched no objects" in result.stderr:
+            return frozenset()
+        # Fallback to raising an exception for other errors.
+        print(result.stderr)
+        result.check_returncode()
+    return frozenset(
+        line.rstrip("/").rsplit("/", 1)[-1] for line in result.stdout.splitlines() if line
+    )
+
+
+def parse_version(version: str) -> Tuple[int, ...]:
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+
+def has_symbols_in_cloud_storage(prefix: str, bundle_id: str) -> bool:
+    return bundle_id in list_bundles_in_cloud_storage(prefix)
 
 
 if __name__ == "__main__":
-    sentry_sdk.init(
-        dsn="https://f86a0e29c86e49688d691e194c5bf9eb@o1.ingest.sentry.io/6418660",
-        traces_sample_rate=1.0,
-    )
     main()
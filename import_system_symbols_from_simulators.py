@@ -1,31 +1,49 @@
 import logging
 import os
+import re
+import shutil
 import subprocess
 import sys
 import tempfile
-from dataclasses import dataclass
-from typing import List
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, replace
+from functools import cached_property
+from typing import Dict, Iterator, List, Tuple
 
 import sentry_sdk
+from sentry_sdk.tracing import Span
 
-from import_system_symbols_from_ipsw import has_symbols_in_cloud_storage, symsorter, upload_to_gcs
+from import_system_symbols_from_ipsw import (
+    MAX_CONCURRENT_EXTRACTIONS,
+    SCRATCH_DIR,
+    extract_span,
+    has_symbols_in_cloud_storage,
+    symsorter,
+    upload_symbols,
+)
 
 
 @dataclass
 class SimulatorRuntime:
     arch: str
     build_number: str
+    # dyld shared cache files of the runtime, listed once when the runtime is found.
+    dsc_files: List[str]
     macos_version: str
     os_name: str
     os_version: str
     path: str
 
-    @property
+    # Runtimes are never mutated, a copy is made per architecture instead.
+    @cached_property
     def bundle_id(self) -> str:
         return f"simulator_{self.macos_version}_{self.os_version}_{self.build_number}_{self.arch}"
 
 
-_simulator_runtime_prefix = "com.apple.CoreSimulator.SimRuntime."
+# e.g. com.apple.CoreSimulator.SimRuntime.iOS-16-0.20A360: OS name, version and build number.
+_simulator_runtime_re = re.compile(
+    r"com\.apple\.CoreSimulator\.SimRuntime\.([^.-]+)-([^.]+)\.([^.]+)"
+)
 _dyld_shared_cache_prefix = "dyld_sim_shared_cache_"
 
 
@@ -38,91 +56,133 @@ def main():
     with sentry_sdk.start_transaction(
         op="task", name="import symbols from simulators"
     ) as transaction:
-        with tempfile.TemporaryDirectory(prefix="_sentry_dyld_shared_cache_") as output_dir:
-            for runtime in find_simulator_runtimes(caches_path):
-                with transaction.start_child(
-                    op="task", description="Process runtime"
-                ) as runtime_span:
-                    runtime_span.set_data("runtime", runtime)
-                    for filename in os.listdir(runtime.path):
-                        if not filename.startswith(_dyld_shared_cache_prefix):
-                            continue
-                        if os.path.splitext(filename)[1] == ".map":
-                            continue
-                        with runtime_span.start_child(
-                            op="task", description="Process file"
-                        ) as file_span:
-                            runtime.arch = filename.split(_dyld_shared_cache_prefix)[1]
-                            file_span.set_data("file", filename)
-                            file_span.set_data("architecture", runtime.arch)
-                            with file_span.start_child(
-                                op="task", description="Check if version has symbols already"
-                            ):
-                                if has_symbols_in_cloud_storage(runtime.os_name, runtime.bundle_id):
-                                    logging.info(
-                                        f"Already have symbols for {runtime.os_name} {runtime.os_version} {runtime.arch} from macOS {runtime.macos_version}, skipping"
-                                    )
-                                    continue
-                            logging.info(
-                                f"Extracting symbols for macOS {runtime.macos_version}, {runtime.os_name} {runtime.os_version} {runtime.arch}"
-                            )
-                            with file_span.start_child(op="task", description="Extract symbols"):
-                                extract_system_symbols(runtime, output_dir)
-            with transaction.start_child(op="task", description="Upload results to GCS"):
-                upload_to_gcs(output_dir)
+        # Files of every runtime go through a single extraction pool, so a runtime with several
+        # architectures doesn't hold back the others. Each bundle is uploaded in the background as
+        # soon as it is sorted.
+        arch_runtimes: List[SimulatorRuntime] = []
+        for runtime in find_simulator_runtimes(caches_path):
+            with transaction.start_child(op="task", description="Process runtime") as runtime_span:
+                runtime_span.set_data("runtime", runtime)
+                # One runtime per shared cache file, each architecture is its own bundle.
+                architectures: List[str] = []
+                for filename in runtime.dsc_files:
+                    arch_runtime = replace(runtime, arch=filename[len(_dyld_shared_cache_prefix) :])
+                    # A set lookup once the bucket is listed, too cheap to be worth a span.
+                    if has_symbols_in_cloud_storage(arch_runtime.os_name, arch_runtime.bundle_id):
+                        logging.info(
+                            f"Already have symbols for {arch_runtime.os_name} {arch_runtime.os_version} {arch_runtime.arch} from macOS {arch_runtime.macos_version}, skipping"
+                        )
+                        continue
+                    logging.info(
+                        f"Extracting symbols for macOS {arch_runtime.macos_version}, {arch_runtime.os_name} {arch_runtime.os_version} {arch_runtime.arch}"
+                    )
+                    architectures.append(arch_runtime.arch)
+                    arch_runtimes.append(arch_runtime)
+                runtime_span.set_data("architectures", architectures)
+        if not arch_runtimes:
+            return
+
+        with tempfile.TemporaryDirectory(
+            prefix="_sentry_dyld_shared_cache_", dir=SCRATCH_DIR
+        ) as output_dir, ThreadPoolExecutor(max_workers=1) as upload_executor:
+            uploads = []
+            with transaction.start_child(op="task", description="Extract symbols"):
+                for bundle_output_dir in extract_system_symbols(arch_runtimes, output_dir):
+                    uploads.append(
+                        upload_executor.submit(upload_symbols, transaction, bundle_output_dir)
+                    )
+            for upload in uploads:
+                upload.result()
 
 
 def find_simulator_runtimes(caches_path: str) -> List[SimulatorRuntime]:
     runtimes: List[SimulatorRuntime] = []
-    for macos_version in os.listdir(caches_path):
-        if macos_version == ".DS_Store":
-            continue
-        for simruntime_name in os.listdir(os.path.join(caches_path, macos_version)):
-            if not simruntime_name.startswith(_simulator_runtime_prefix):
+    # scandir entries carry their type, so stray files like .DS_Store are skipped without a stat.
+    with os.scandir(caches_path) as entries:
+        macos_dirs = [entry for entry in entries if entry.is_dir()]
+    for macos_dir in macos_dirs:
+        with os.scandir(macos_dir.path) as entries:
+            runtime_dirs = list(entries)
+        for runtime_dir in runtime_dirs:
+            match = _simulator_runtime_re.match(runtime_dir.name)
+            if match is None:
                 continue
-            splits = simruntime_name.split(".")
-            build_number = splits[5]
-            os_info = splits[4].split("-")
-            os_version = ".".join(os_info[1:3])
-            os_name = os_info[0].lower()
-            path = os.path.join(caches_path, macos_version, simruntime_name)
-            for filename in os.listdir(path):
-                if not filename.startswith(_dyld_shared_cache_prefix):
-                    continue
-                arch = filename.split(_dyld_shared_cache_prefix)[1]
-                runtimes.append(
-                    SimulatorRuntime(
-                        arch=arch,
-                        build_number=build_number,
-                        macos_version=macos_version,
-                        os_name=os_name,
-                        os_version=os_version,
-                        path=path,
-                    )
+            os_name, version, build_number = match.groups()
+            os_version = ".".join(version.split("-")[:2])
+            # Skip the .map files and the subcaches (.01, .02...), the extractor reads the latter
+            # through the main cache file.
+            with os.scandir(runtime_dir.path) as entries:
+                dsc_files = [
+                    entry.name
+                    for entry in entries
+                    if entry.name.startswith(_dyld_shared_cache_prefix) and "." not in entry.name
+                ]
+            if not dsc_files:
+                continue
+            runtimes.append(
+                SimulatorRuntime(
+                    arch=dsc_files[0][len(_dyld_shared_cache_prefix) :],
+                    build_number=build_number,
+                    dsc_files=dsc_files,
+                    macos_version=macos_dir.name,
+                    os_name=os_name.lower(),
+                    os_version=os_version,
+                    path=runtime_dir.path,
                 )
-                break
+            )
     return runtimes
 
 
-def extract_system_symbols(runtime: SimulatorRuntime, output_dir: str) -> None:
+def extract_system_symbols(runtimes: List[SimulatorRuntime], output_dir: str) -> Iterator[str]:
+    """Extracts and sorts the shared cache of each runtime, yields each bundle's directory."""
     span = sentry_sdk.Hub.current.scope.span
-    for filename in os.listdir(runtime.path):
-        if not filename.startswith(_dyld_shared_cache_prefix):
-            continue
-        if os.path.splitext(filename)[1] == ".map":
-            continue
-        with span.start_child(
-            op="task", description="Extract symbols from runtime file"
-        ) as file_span:
-            file_span.set_data("runtime_file", filename)
-            with tempfile.TemporaryDirectory(prefix="_sentry_dyld_output") as dsc_out_dir:
-                full_path = os.path.join(runtime.path, filename)
-                with file_span.start_child(
-                    op="task", description="Run dyld-shared-cache-extractor"
-                ):
-                    subprocess.check_call(["dyld-shared-cache-extractor", full_path, dsc_out_dir])
-                with file_span.start_child(op="task", description="Run symsorter"):
-                    symsorter(output_dir, runtime.os_name, runtime.bundle_id, dsc_out_dir)
+    # The next cache is extracted while symsorter runs on the previous one, on this thread. A new
+    # extraction is only started once a sorted cache has been deleted, so no more than
+    # MAX_CONCURRENT_EXTRACTIONS extracted caches are on disk at once.
+    pending = list(runtimes)
+    extractions: Dict["Future[None]", Tuple[SimulatorRuntime, str]] = {}
+    with tempfile.TemporaryDirectory(
+        prefix="_sentry_dyld_output", dir=SCRATCH_DIR
+    ) as scratch_dir, ThreadPoolExecutor(
+        max_workers=MAX_CONCURRENT_EXTRACTIONS
+    ) as extractor_executor:
+        while pending or extractions:
+            while pending and len(extractions) < MAX_CONCURRENT_EXTRACTIONS:
+                runtime = pending.pop(0)
+                # Each cache is extracted into its own folder of the shared scratch directory.
+                dsc_out_dir = tempfile.mkdtemp(prefix=f"{runtime.bundle_id}_", dir=scratch_dir)
+                extraction = extractor_executor.submit(
+                    extract_dyld_shared_cache, span, runtime, dsc_out_dir
+                )
+                extractions[extraction] = (runtime, dsc_out_dir)
+            done, _ = wait(extractions, return_when=FIRST_COMPLETED)
+            for extraction in done:
+                runtime, dsc_out_dir = extractions.pop(extraction)
+                bundle_output_dir = tempfile.mkdtemp(prefix=f"{runtime.bundle_id}_", dir=output_dir)
+                try:
+                    extraction.result()
+                    with extract_span(span, "Run symsorter"):
+                        symsorter(
+                            bundle_output_dir, runtime.os_name, runtime.bundle_id, dsc_out_dir
+                        )
+                finally:
+                    # Free the space before the next extraction is started.
+                    shutil.rmtree(dsc_out_dir, ignore_errors=True)
+                yield bundle_output_dir
+
+
+def extract_dyld_shared_cache(
+    parent_span: Span, runtime: SimulatorRuntime, dsc_out_dir: str
+) -> None:
+    # Runs on a worker thread, so use a dedicated hub to keep the main thread's scope intact.
+    with sentry_sdk.Hub(sentry_sdk.Hub.current):
+        with extract_span(parent_span, "Run dyld-shared-cache-extractor") as span:
+            filename = f"{_dyld_shared_cache_prefix}{runtime.arch}"
+            if span is not None:
+                span.set_data("runtime_file", filename)
+            subprocess.check_call(
+                ["dyld-shared-cache-extractor", os.path.join(runtime.path, filename), dsc_out_dir]
+            )
 
 
 if __name__ == "__main__":
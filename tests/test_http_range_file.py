@@ -0,0 +1,109 @@
+import io
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from unittest import mock
+
+from urllib3.exceptions import ProtocolError
+
+import import_system_symbols_from_ipsw as ipsw
+
+DATA = bytes(range(256)) * 64
+BLOCK_SIZE = 4096
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # Faults injected into the next responses, in order: "short" or "ignore_range".
+    faults: List[str] = []
+    ranges: List[str] = []
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(DATA)))
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        self.ranges.append(self.headers["Range"])
+        fault = self.faults.pop(0) if self.faults else None
+        if fault == "ignore_range":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(DATA)))
+            self.end_headers()
+            self.wfile.write(DATA)
+            return
+        start, end = (int(bound) for bound in self.headers["Range"][len("bytes=") :].split("-"))
+        body = DATA[start : end + 1]
+        if fault == "short":
+            body = body[:-1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{start + len(body) - 1}/{len(DATA)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+class HTTPRangeFileTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/archive.ipsw"
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self) -> None:
+        RangeHandler.faults = []
+        RangeHandler.ranges = []
+        patcher = mock.patch.object(ipsw, "REMOTE_ARCHIVE_BLOCK_SIZE", BLOCK_SIZE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_and_seeks(self) -> None:
+        archive = ipsw.open_remote_archive(self.url)
+        assert archive is not None
+        with archive:
+            self.assertEqual(archive.read(), DATA)
+            archive.seek(1000)
+            self.assertEqual(archive.read(5000), DATA[1000:6000])
+            archive.seek(-10, io.SEEK_END)
+            self.assertEqual(archive.read(), DATA[-10:])
+
+    def test_short_body_is_fetched_again(self) -> None:
+        RangeHandler.faults = ["short"]
+        with ipsw.HTTPRangeFile(self.url, len(DATA)) as f:
+            self.assertEqual(f.read(BLOCK_SIZE), DATA[:BLOCK_SIZE])
+        self.assertEqual(RangeHandler.ranges, [f"bytes=0-{BLOCK_SIZE - 1}"] * 2)
+
+    def test_short_body_fails_after_all_attempts(self) -> None:
+        RangeHandler.faults = ["short"] * ipsw.DOWNLOAD_ATTEMPTS
+        with ipsw.HTTPRangeFile(self.url, len(DATA)) as f:
+            with self.assertRaises(ProtocolError):
+                f.read(BLOCK_SIZE)
+
+    def test_seek_back_into_a_dropped_block(self) -> None:
+        with ipsw.HTTPRangeFile(self.url, len(DATA), read_ahead=1) as f:
+            for block_start in range(0, 3 * BLOCK_SIZE, BLOCK_SIZE):
+                self.assertEqual(f.read(BLOCK_SIZE), DATA[block_start : block_start + BLOCK_SIZE])
+            # The first block was dropped once reads moved past it, so it is fetched again.
+            f.seek(10)
+            self.assertEqual(f.read(BLOCK_SIZE), DATA[10:BLOCK_SIZE])
+        starts = sorted(int(r[len("bytes=") :].split("-")[0]) for r in RangeHandler.ranges)
+        self.assertEqual(starts, [0, 0, BLOCK_SIZE, 2 * BLOCK_SIZE, 3 * BLOCK_SIZE])
+
+    def test_ignored_range_is_an_error(self) -> None:
+        RangeHandler.faults = ["ignore_range"]
+        with ipsw.HTTPRangeFile(self.url, len(DATA)) as f:
+            with self.assertRaisesRegex(RuntimeError, "ignored the range request"):
+                f.read(BLOCK_SIZE)
+
+
+if __name__ == "__main__":
+    unittest.main()